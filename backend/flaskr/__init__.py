@@ -1,30 +1,261 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS, cross_origin
+from sqlalchemy import Integer, bindparam, event, or_, select, text
+import sqlalchemy.exc as exc
+from sqlalchemy.util import LRUCache
 from sqlalchemy.sql.expression import func
+import hashlib
+import hmac
+import orjson
 import random
-import json
+import threading
+import time
+import uuid
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 QUESTIONS_PER_SHELF = 10
+QUESTION_COUNT_TTL = 30
+# same keys as Question.format()
+QUESTION_KEYS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = [Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty]
+
+_question_count_cache = {'value': None, 'ts': 0}
+_question_count_lock = threading.Lock()
+_categories_cache = {'data': None, 'response': None}
+# compiled forms of the module-level question statements below
+_STATEMENT_CACHE = LRUCache(100)
+
+# one page of questions, the categories and the total number of questions
+# fetched in a single round-trip
+QUESTIONS_PAGE_SQL = text('''
+    WITH q AS (
+        SELECT id, question, answer, category, difficulty
+        FROM questions
+        WHERE CAST(:after_id AS integer) IS NULL OR id > :after_id
+        ORDER BY id
+        LIMIT :lim OFFSET :off
+    )
+    SELECT (SELECT coalesce(json_agg(q ORDER BY q.id), '[]') FROM q),
+           (SELECT json_object_agg(id, type ORDER BY id) FROM categories),
+           (SELECT count(*) FROM questions)
+''')
+
+
+def page_bounds(request):
+    # keyset pagination when the client follows the `after_id` cursor,
+    # plain page numbers otherwise
+    after_id = request.args.get('after_id', None, type=int)
+    if after_id is not None:
+        return after_id, 0
 
-
-def paginate_questions(request, selection):
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_SHELF
-    end = start + QUESTIONS_PER_SHELF
+    if page < 1:
+        abort(400)
+    return None, (page - 1) * QUESTIONS_PER_SHELF
+
+
+def select_questions(*criterion):
+    # one page of questions, every value is a bound parameter so the
+    # statement is built once and its compiled form reused
+    after_id = bindparam('after_id', type_=Integer)
+    selection = select(QUESTION_COLUMNS).where(
+        or_(after_id.is_(None), Question.id > after_id)
+    ).order_by(Question.id)
+    for condition in criterion:
+        selection = selection.where(condition)
+    return selection.limit(bindparam('lim')).offset(bindparam('off'))
+
+
+ALL_QUESTIONS = select_questions()
+CATEGORY_QUESTIONS = select_questions(
+    Question.category == bindparam('category_id'))
+# served by the trigram index on lower(question)
+SEARCH_QUESTIONS = select_questions(
+    func.lower(Question.question).like(
+        func.lower(bindparam('search_pattern'))))
+
+
+def paginate_questions(request, selection, params=None):
+    after_id, start = page_bounds(request)
+    params = dict(params or {}, after_id=after_id,
+                  lim=QUESTIONS_PER_SHELF, off=start)
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+    rows = db.session.connection().execution_options(
+        compiled_cache=_STATEMENT_CACHE).execute(selection, params).fetchall()
+    current_questions = [dict(zip(QUESTION_KEYS, row)) for row in rows]
 
     return current_questions
 
 
+def get_categories_dict():
+    # memoized for the current request in g, then for the process
+    if 'cats' not in g:
+        categories = _categories_cache['data']
+        if categories is None:
+            categories = {
+                category.id: category.type
+                for category in Category.query.order_by(Category.id)}
+            _categories_cache['data'] = categories
+        g.cats = categories
+    return g.cats
+
+
+def store_categories_dict(categories):
+    # categories fetched alongside other data only fill a cold cache,
+    # warm categories are replaced by invalidate_categories() alone
+    if _categories_cache['data'] is None:
+        _categories_cache['data'] = categories
+
+
+def get_categories_response():
+    # the /categories body and its ETag are serialized once and reused
+    # until the categories change
+    response = _categories_cache['response']
+    if response is None:
+        body = orjson.dumps({
+            'success': True,
+            'categories': get_categories_dict()
+        }, option=orjson.OPT_NON_STR_KEYS)
+        response = (body, hashlib.sha1(body).hexdigest())
+        _categories_cache['response'] = response
+    return response
+
+
+def invalidate_categories(*args):
+    if has_app_context():
+        g.pop('cats', None)
+    _categories_cache['data'] = None
+    _categories_cache['response'] = None
+
+
+def warm_categories():
+    invalidate_categories()
+    get_categories_response()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Category, _event, invalidate_categories)
+
+
+def ojsonify(payload, status=200):
+    # category ids are used as keys of the categories object
+    return Response(orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+                    status=status, mimetype='application/json')
+
+
+def random_question(*criterion):
+    # seek from a random id between the smallest and the largest matching
+    # ids instead of sorting every matching row with ORDER BY random()
+    min_id, max_id = db.session.query(
+        func.min(Question.id), func.max(Question.id)).filter(
+        *criterion).first()
+    if min_id is None:
+        return None
+
+    question = Question.query.filter(
+        Question.id >= random.randint(min_id, max_id), *criterion
+    ).order_by(Question.id).first()
+    if question is None:
+        # excluded ids can leave no match after the picked id
+        question = Question.query.filter(*criterion).order_by(
+            func.random()).first()
+    return question
+
+
+def get_json_body():
+    try:
+        body = orjson.loads(request.data)
+    except orjson.JSONDecodeError:
+        abort(400)
+
+    if not isinstance(body, dict):
+        abort(400)
+    return body
+
+
+def is_id(value):
+    # ids are sent as JSON numbers, or as numeric strings for categories
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    return isinstance(value, str) and value.isascii() and value.isdigit()
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+def count_questions(*criterion):
+    if criterion:
+        return db.session.query(func.count(Question.id)).filter(
+            *criterion).scalar()
+
+    total = cached_question_count()
+    if total is None:
+        total = db.session.query(func.count(Question.id)).scalar()
+        set_question_count(total)
+    return total
+
+
+def cached_question_count():
+    # the total number of questions is cached for a short time
+    # and invalidated whenever a question is created or deleted
+    with _question_count_lock:
+        if (time.monotonic() - _question_count_cache['ts'] >=
+                QUESTION_COUNT_TTL):
+            return None
+        return _question_count_cache['value']
+
+
+def set_question_count(total):
+    with _question_count_lock:
+        _question_count_cache['value'] = total
+        _question_count_cache['ts'] = time.monotonic()
+
+
+def reset_caches():
+    invalidate_categories()
+    invalidate_question_count()
+
+
+def invalidate_question_count():
+    with _question_count_lock:
+        _question_count_cache['value'] = None
+
+
+def get_questions_page(request):
+    total = cached_question_count()
+
+    if total is not None and _categories_cache['data'] is not None:
+        return (paginate_questions(request, ALL_QUESTIONS),
+                get_categories_dict(), total)
+
+    after_id, start = page_bounds(request)
+    questions, categories, total = db.session.execute(QUESTIONS_PAGE_SQL, {
+        'after_id': after_id,
+        'lim': QUESTIONS_PER_SHELF,
+        'off': start
+    }).first()
+
+    store_categories_dict({
+        int(category_id): category_type
+        for category_id, category_type in (categories or {}).items()})
+    set_question_count(total)
+
+    return questions, get_categories_dict(), total
+
+
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.config['ADMIN_TOKEN'] = os.environ.get('TRIVIA_ADMIN_TOKEN')
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
 
     '''
@@ -35,6 +266,11 @@ def create_app(test_config=None):
     '''
   after_request decorator to set Access-Control-Allow
   '''
+    @app.before_request
+    def set_request_id():
+        g.request_id = (request.headers.get('X-Request-ID') or
+                        uuid.uuid4().hex)
+
     # CORS Headers
     @app.after_request
     def after_request(response):
@@ -42,6 +278,7 @@ def create_app(test_config=None):
                              'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,PUT,POST,DELETE,OPTIONS')
+        response.headers['X-Request-ID'] = g.get('request_id', '')
         return response
 
     '''
@@ -50,16 +287,32 @@ def create_app(test_config=None):
   '''
     @app.route('/categories', methods=['GET'])
     def get_categories():
-        try:
-            categories = Category.query.all()
-            formated_categories = {
-                category.id: category.type for category in categories}
-            return jsonify({
-                'success': True,
-                'categories': formated_categories
-            })
-        except:
-            abort(422)
+        body, etag = get_categories_response()
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    '''
+  POST endpoint to rebuild the categories cache
+  after the categories table was changed outside of the app.
+  Only available when an admin token is configured, and only
+  refreshes the process handling the request.
+  '''
+    @app.route('/categories/refresh', methods=['POST'])
+    def refresh_categories():
+        token = app.config['ADMIN_TOKEN']
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(
+                request.headers.get('X-Admin-Token', '').encode('utf-8'),
+                token.encode('utf-8')):
+            abort(403)
+
+        warm_categories()
+        return ojsonify({
+            'success': True,
+            'categories': get_categories_dict()
+        })
     '''
   GET requests for questions,
   including pagination (every 10 questions).
@@ -73,24 +326,20 @@ def create_app(test_config=None):
   '''
     @app.route('/questions', methods=['GET'])
     def get_questions():
-        try:
-            selection = Question.query.all()
-            current_questions = paginate_questions(request, selection)
-
-            if (len(current_questions) == 0):
-                abort(404)
-
-            formated_categories = {
-                category.id: category.type for category in Category.query.all()}
-            return jsonify({
-                'success': True,
-                'questions': current_questions,
-                'categories': formated_categories,
-                'total_questions': len(selection),
-                'current_category': []
-            })
-        except:
-            abort(422)
+        current_questions, formated_categories, total = \
+            get_questions_page(request)
+
+        if (len(current_questions) == 0):
+            abort(404)
+
+        return ojsonify({
+            'success': True,
+            'questions': current_questions,
+            'categories': formated_categories,
+            'total_questions': total,
+            'current_category': [],
+            'next_after_id': current_questions[-1]['id']
+        })
     '''
   An endpoint to DELETE question using a question ID.
 
@@ -99,29 +348,25 @@ def create_app(test_config=None):
   '''
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
-        try:
-            question = Question.query.filter(
-                Question.id == question_id).one_or_none()
-
-            if question is None:
-                abort(404)
-            question.delete()
-
-            selection = Question.query.all()
-            current_questions = paginate_questions(request, selection)
-            formated_categories = {
-                category.id: category.type for category in Category.query.all()}
-
-            return jsonify({
-                'success': True,
-                'deleted': question_id,
-                'questions': current_questions,
-                'categories': formated_categories,
-                'total_questions': len(selection),
-                'current_category': []
-            })
-        except:
+        question = Question.query.filter(
+            Question.id == question_id).one_or_none()
+
+        if question is None:
             abort(404)
+        question.delete()
+        invalidate_question_count()
+
+        current_questions = paginate_questions(request, ALL_QUESTIONS)
+        formated_categories = get_categories_dict()
+
+        return ojsonify({
+            'success': True,
+            'deleted': question_id,
+            'questions': current_questions,
+            'categories': formated_categories,
+            'total_questions': count_questions(),
+            'current_category': []
+        })
     '''
   POST a new question,
   which  require the question and answer text,
@@ -130,32 +375,35 @@ def create_app(test_config=None):
   TEST: When you submit a question on the "Add" tab,
   the form will clear and the question will appear at the end of the last page
   of the questions list in the "List" tab.
+  Only the id of the new question and the new total are returned.
   '''
     @app.route('/questions', methods=['POST'])
     @cross_origin(supports_credentials=True)
     def create_question():
-        try:
-            body = request.get_json()
-
-            new_question = body.get('question', None)
-            new_answer = body.get('answer', None)
-            difficulty = body.get('difficulty', None)
-            category = body.get('category', None)
-
-            question = Question(question=new_question, answer=new_answer,
-                                difficulty=difficulty, category=category)
-            question.insert()
-
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
-            return jsonify({
-                'success': True,
-                'questions': current_questions,
-                'created': question.id,
-                'total_questions': len(Question.query.all())
-            })
-        except:
-            abort(405)
+        body = get_json_body()
+
+        new_question = body.get('question', None)
+        new_answer = body.get('answer', None)
+        difficulty = body.get('difficulty', None)
+        category = body.get('category', None)
+
+        if not all(is_scalar(value) for value in
+                   (new_question, new_answer, difficulty, category)):
+            abort(400)
+
+        question_id = db.session.execute(
+            Question.__table__.insert().values(
+                question=new_question, answer=new_answer,
+                difficulty=difficulty, category=category
+            ).returning(Question.id)).scalar()
+        db.session.commit()
+        invalidate_question_count()
+
+        return ojsonify({
+            'success': True,
+            'created': question_id,
+            'total_questions': count_questions()
+        })
 
     '''
   POST endpoint to get questions based on a search term.
@@ -170,23 +418,21 @@ def create_app(test_config=None):
     @app.route('/questions/search', methods=['POST'])
     @cross_origin(supports_credentials=True)
     def search_question():
-        try:
-            body = request.get_json()
-            search = body.get('searchTerm', None)
-
-            if search:
-                selection = Question.query.order_by(Question.id).filter(
-                    Question.question.ilike('%{}%'.format(search)))
-                current_questions = paginate_questions(request, selection)
-
-                return jsonify({
-                    'success': True,
-                    'questions': current_questions,
-                    'total_questions': len(Question.query.all()),
-                    'current_category': []
-                })
-        except:
-            abort(422)
+        body = get_json_body()
+        search = body.get('searchTerm', None)
+
+        if not search or not isinstance(search, str):
+            abort(400)
+
+        current_questions = paginate_questions(
+            request, SEARCH_QUESTIONS, {'search_pattern': '%' + search + '%'})
+
+        return ojsonify({
+            'success': True,
+            'questions': current_questions,
+            'total_questions': count_questions(),
+            'current_category': []
+        })
 
     '''
   GET endpoint to get questions based on category.
@@ -197,21 +443,22 @@ def create_app(test_config=None):
   '''
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
     def get_questions_by_category(category_id):
-        try:
-            selection = Question.query.filter(
-                Question.category == category_id).all()
-            current_questions = paginate_questions(request, selection)
-            current_category = Category.query.filter(
-                Category.id == category_id).one_or_none()
-            return jsonify({
-                'success': True,
-                'questions': current_questions,
-                'total_questions': len(selection),
-                'current_category': current_category.format()
-            })
-        except:
+        current_category = Category.query.filter(
+            Category.id == category_id).one_or_none()
+
+        if current_category is None:
             abort(404)
 
+        current_questions = paginate_questions(
+            request, CATEGORY_QUESTIONS, {'category_id': category_id})
+        return ojsonify({
+            'success': True,
+            'questions': current_questions,
+            'total_questions': count_questions(
+                Question.category == category_id),
+            'current_category': current_category.format()
+        })
+
     '''
   POST endpoint to get questions to play the quiz.
   This endpoint take category and previous question parameters
@@ -224,71 +471,105 @@ def create_app(test_config=None):
   '''
     @app.route("/quizzes", methods=['POST'])
     def play_quizzes():
-        current_question = Question.query.order_by(
-            func.random()).first()
         if request.data:
-            search_data = json.loads(request.data.decode('utf-8'))
+            search_data = get_json_body()
+            quiz_category = search_data.get('quiz_category', {})
+            previous_questions = search_data.get('previous_questions', [])
+            if (not isinstance(quiz_category, dict)
+                    or not is_id(quiz_category.get('id', 0))
+                    or not isinstance(previous_questions, list)
+                    or not all(is_id(question_id)
+                               for question_id in previous_questions)):
+                abort(400)
             if (('quiz_category' in search_data
                  and 'id' in search_data['quiz_category'])
                     and 'previous_questions' in search_data):
-                questions_query = Question.query.filter_by(
-                    category=search_data['quiz_category']['id']
-                ).filter(
-                    Question.id.notin_(search_data["previous_questions"])
-                ).all()
-                length_of_available_question = len(questions_query)
-                if length_of_available_question > 0:
-                    result = {
-                        "success": True,
-                        "question": Question.format(
-                            questions_query[random.randrange(
-                                0,
-                                length_of_available_question
-                            )]
-                        )
-                    }
-                else:
-                    result = {
-                        "success": True,
-                        "question": current_question.format()
-                    }
-                return jsonify(result)
+                current_question = random_question(
+                    Question.category == search_data['quiz_category']['id'],
+                    Question.id.notin_(search_data["previous_questions"]))
+                if current_question is None:
+                    current_question = random_question()
+                if current_question is None:
+                    abort(404)
+                result = {
+                    "success": True,
+                    "question": current_question.format()
+                }
+                return ojsonify(result)
             abort(404)
         abort(422)
     '''
   Erros handlers for all expected errors
-  including 404 and 422.
+  including 400, 404, 422, 500 and 503.
+  Database errors are answered with a 422 when caused by the
+  request data, a 503 when the database is unreachable,
+  and anything else unexpected with a 500.
   '''
+    @app.errorhandler(403)
+    def forbidden(error):
+        return ojsonify({
+            "success": False,
+            "error": 403,
+            "message": "Forbidden"
+        }, 403)
+
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return ojsonify({
             "success": False,
             "error": 404,
             "message": "Not found"
-        }), 404
+        }, 404)
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return ojsonify({
             "success": False,
             "error": 422,
             "message": "Unprocessable"
-        }), 422
+        }, 422)
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return ojsonify({
             "success": False,
             "error": 400,
-            "message": "Not found"
-        }), 400
+            "message": "Bad request"
+        }, 400)
+
+    @app.errorhandler(exc.SQLAlchemyError)
+    def database_error(error):
+        db.session.rollback()
+        app.logger.exception('request %s: database error',
+                             g.get('request_id'))
+        # data sent by the client that the database refused
+        if isinstance(error, (exc.DataError, exc.IntegrityError)):
+            return unprocessable(error)
+        # database down or connection pool exhausted
+        if isinstance(error, (exc.OperationalError, exc.TimeoutError,
+                              exc.DisconnectionError)):
+            return service_unavailable(error)
+        return internal_server_error(error)
 
     @app.errorhandler(500)
-    def bad_request(error):
-        return jsonify({
+    def internal_server_error(error):
+        app.logger.error('request %s: unhandled error', g.get('request_id'))
+        return ojsonify({
             "success": False,
             "error": 500,
-            "message": "Not authorized"
-        }), 500
+            "message": "Internal server error"
+        }, 500)
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return ojsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service unavailable"
+        }, 503)
+
+    # categories are built once per process, before the first request
+    with app.app_context():
+        warm_categories()
 
     return app
@@ -1,5 +1,6 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, Index, DDL, create_engine
+from sqlalchemy import event
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -9,6 +10,10 @@ database_path = "postgres://{}:{}@{}/{}".format(
 
 db = SQLAlchemy()
 
+# pg_trgm backs the trigram index used by the question search
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -18,6 +23,12 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 300
+    }
     db.app = app
     db.init_app(app)
     db.create_all()
@@ -31,6 +42,9 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('questions_category_id_idx', 'category', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
@@ -65,6 +79,12 @@ class Question(db.Model):
         }
 
 
+# the search matches '%term%' patterns on lower(question)
+event.listen(Question.__table__, 'after_create', DDL(
+    'CREATE INDEX questions_question_trgm_idx ON questions '
+    'USING gin (lower(question) gin_trgm_ops)'))
+
+
 '''
 Category
 
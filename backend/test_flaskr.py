@@ -3,7 +3,7 @@ import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
 
-from flaskr import create_app
+from flaskr import create_app, reset_caches
 from models import setup_db, Question, Category
 
 
@@ -12,12 +12,14 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = create_app({'ADMIN_TOKEN': 'admin-token'})
         self.client = self.app.test_client
         self.database_name = "trivia_test"
         self.database_path = "postgres://{}:{}@{}/{}".format(
             'postgres', 'password', 'localhost:5432', self.database_name)
         setup_db(self.app, self.database_path)
+        # the app caches are filled from the default database
+        reset_caches()
 
         # binds the app to the current context
         with self.app.app_context():
@@ -34,6 +36,40 @@ class TriviaTestCase(unittest.TestCase):
     Write at least one test for each test for successful operation and for expected errors.
     """
 
+    def test_get_categories_not_modified(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/categories',
+                                headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_refresh_categories(self):
+        res = self.client().post('/categories/refresh',
+                                 headers={'X-Admin-Token': 'admin-token'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['categories']), len(Category.query.all()))
+
+    def test_403_refresh_categories_without_admin_token(self):
+        res = self.client().post('/categories/refresh')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Forbidden')
+
+    def test_403_refresh_categories_with_non_ascii_token(self):
+        res = self.client().post('/categories/refresh',
+                                 headers={'X-Admin-Token': 'adm\xefn'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
     def test_get_paginated_questions(self):
         res = self.client().get('/questions')
         data = json.loads(res.data)
@@ -45,13 +81,34 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], len(Question.query.all()))
         self.assertEqual(len(data['questions']), 10)
 
+    def test_get_questions_after_id(self):
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        res = self.client().get(
+            '/questions?after_id={}'.format(first_page['next_after_id']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(question['id'] > first_page['next_after_id']
+                            for question in data['questions']))
+
     def test_404_sent_requesting_beyond_valid_page(self):
         res = self.client().get('/questions?page=9999')
         data = json.loads(res.data.decode('utf-8'))
-        print(data)
-        self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Not found')
+
+    def test_400_sent_requesting_page_below_one(self):
+        res = self.client().get('/questions?page=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Bad request')
 
     def test_create_new_question(self):
         new_question = {
@@ -67,7 +124,20 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['total_questions'])
-        self.assertTrue(len(data['questions']))
+        self.assertTrue(Question.query.get(data['created']))
+
+    def test_400_if_new_question_fields_are_not_scalars(self):
+        new_question = {
+            'question': {},
+            'answer': 'White',
+            'difficulty': 1,
+            'category': 4
+        }
+        res = self.client().post('/questions', json=new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
 
     def test_404_if_creation_not_possible(self):
         new_question = {
@@ -116,6 +186,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertEqual(len(data['questions']), 2)
 
+    def test_get_question_search_after_id(self):
+        search_term = {
+            'searchTerm': 'title'
+        }
+        res = self.client().post('/questions/search', json=search_term)
+        first_id = json.loads(res.data)['questions'][0]['id']
+        res = self.client().post(
+            '/questions/search?after_id={}'.format(first_id),
+            json=search_term)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 1)
+        self.assertTrue(data['questions'][0]['id'] > first_id)
+
     def test_get_question_search_without_results(self):
         search_term = {
             'searchTerm': 'toto'
@@ -128,6 +213,29 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'], 0)
         self.assertEqual(len(data['questions']), 0)
 
+    def test_400_if_search_body_is_not_json(self):
+        res = self.client().post('/questions/search', data='not json')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_400_if_search_body_is_not_an_object(self):
+        res = self.client().post('/questions/search', json=['title'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_400_if_search_term_is_not_a_string(self):
+        res = self.client().post('/questions/search', json={'searchTerm': 5})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_get_question_by_category(self):
         res = self.client().get('/categories/2/questions')
         data = json.loads(res.data)
@@ -155,6 +263,49 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
+        self.assertNotIn(data['question']['id'],
+                         previous_questions['previous_questions'])
+        self.assertEqual(str(data['question']['category']), '5')
+
+    def test_quizzes_skip_previous_questions(self):
+        questions = Question.query.filter(Question.category == 5).all()
+        previous_questions = {'previous_questions': [question.id for question
+                                                     in questions[1:]],
+                              'quiz_category': {'id': '5',
+                                                'type': 'Entertainment'}}
+        res = self.client().post('/quizzes', json=previous_questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], questions[0].id)
+
+    def test_400_if_quizzes_body_is_not_an_object(self):
+        res = self.client().post('/quizzes', data='null',
+                                 content_type='application/json')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_if_quizzes_previous_questions_are_not_ids(self):
+        previous_questions = {'previous_questions': ['abc'],
+                              'quiz_category': {'id': '5',
+                                                'type': 'History'}}
+        res = self.client().post('/quizzes', json=previous_questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_400_if_quizzes_category_id_is_not_an_id(self):
+        previous_questions = {'previous_questions': [],
+                              'quiz_category': {'id': {}}}
+        res = self.client().post('/quizzes', json=previous_questions)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
 
     def test_not_processing_quizzes(self):
         previous_questions = {}